@@ -3,7 +3,6 @@ import logging
 import time
 import datetime
 import os
-import shutil
 
 import therefore_document_gatherer
 import therefore_document_processor
@@ -37,44 +36,23 @@ def parse_interval(interval_str):
         logging.error(f"Invalid interval format: {interval_str}")
         return None
 
-def ensure_directories(config_path, db_dir, vectordb_dir, output_dir="output"):
-    """Ensure required directories exist for config, dbs, vectordb and output."""
+def ensure_directories(config_path, db_dir, vectordb_dir):
+    """Ensure required directories exist for config, dbs and vectordb."""
     dirs_to_create = [
         os.path.dirname(config_path),
         db_dir,
-        vectordb_dir,
-        output_dir
+        vectordb_dir
     ]
     for d in dirs_to_create:
         if d and not os.path.exists(d):
             os.makedirs(d, exist_ok=True)
             logging.info(f"Created missing directory: {d}")
 
-def clear_output_dir(output_dir="output"):
-    """Delete all contents of the output directory, but keep the folder."""
-    if os.path.exists(output_dir):
-        for filename in os.listdir(output_dir):
-            file_path = os.path.join(output_dir, filename)
-            try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)  # remove file or symlink
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)  # remove subdir
-            except Exception as e:
-                logging.error(f"Failed to delete {file_path}: {e}")
-        logging.info(f"Cleared output directory: {output_dir}")
-    else:
-        os.makedirs(output_dir, exist_ok=True)
-        logging.info(f"Created output directory: {output_dir}")
-
 # ----------------------------
 # Pipeline runner
 # ----------------------------
 def run_pipeline(config_path, tenant_name, db_dir, vectordb_dir):
     """Run a single gather + process cycle."""
-    # Clear output folder before each run
-    clear_output_dir("output")
-
     pipeline_start = time.time()
     logging.info("=== Starting pipeline run ===")
 
@@ -130,7 +108,7 @@ if __name__ == "__main__":
     interval_str = args.interval or os.environ.get("INTERVAL")
 
     # Ensure all directories exist
-    ensure_directories(config_path, db_dir, vectordb_dir, output_dir="output")
+    ensure_directories(config_path, db_dir, vectordb_dir)
 
     # Parse interval and run
     interval_seconds = parse_interval(interval_str)
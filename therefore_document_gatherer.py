@@ -6,9 +6,29 @@ import sqlite3
 import time
 import datetime
 
+import therefore_functions
+import utils
+
 DEFAULT_CONFIG_PATH = 'config/config.json'
 DEFAULT_DB_DIR = 'db/docs'
 DEFAULT_TENANT_NAME = 'defaulttenant'
+CATEGORY_CACHE_TTL = 3600  # seconds
+
+# (base url, tenant, auth token) -> (expiry, category list), kept across scheduled runs
+_category_cache = {}
+
+CREATE_DOCUMENTS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS documents (
+        DocNo INTEGER PRIMARY KEY,
+        Version INTEGER,
+        Data TEXT
+    )
+'''
+UPSERT_DOCUMENT_SQL = '''
+    INSERT INTO documents (DocNo, Version, Data) VALUES (?, ?, ?)
+    ON CONFLICT (DocNo) DO UPDATE SET Version = excluded.Version, Data = excluded.Data
+    WHERE documents.Version IS NOT excluded.Version
+'''
 
 # ----------------------------
 # Logging configuration
@@ -19,14 +39,43 @@ logging.basicConfig(
 )
 
 
-def get_therefore_documents_for_processing(config_path=DEFAULT_CONFIG_PATH, tenant_name=None, db_dir=DEFAULT_DB_DIR):
-    import therefore_functions
-    import utils
+def get_categories(tenant_config, auth_token):
+    """Return the tenant's categories, reusing a listing fetched within CATEGORY_CACHE_TTL seconds."""
+    key = (tenant_config['BaseUrl'], tenant_config['Tenant'], auth_token)
+    cached = _category_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    category_list = therefore_functions.get_all_categories(
+        tenant_config['BaseUrl'],
+        tenant_config['Tenant'],
+        auth_token
+    )
+    _category_cache[key] = (time.monotonic() + CATEGORY_CACHE_TTL, category_list)
+    return category_list
+
+
+def upsert_documents(cursor, rows):
+    """Store one block of query rows in its own transaction and return how many were new or changed."""
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        # Rows whose version is unchanged are skipped by SQLite itself
+        cursor.executemany(
+            UPSERT_DOCUMENT_SQL,
+            ((row.get('DocNo'), row.get('VersionNo'), utils.dumps_json(row)) for row in rows)
+        )
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    changed = cursor.rowcount
+    cursor.execute('COMMIT')
+    return changed
+
 
+def get_therefore_documents_for_processing(config_path=DEFAULT_CONFIG_PATH, tenant_name=None, db_dir=DEFAULT_DB_DIR):
     # Load configuration from config.json
     try:
-        with open(config_path, 'r') as config_file:
-            config = json.load(config_file)
+        config = utils.load_config(config_path)
     except FileNotFoundError:
         logging.error(f"Configuration file not found: {config_path}")
         return
@@ -60,11 +109,7 @@ def get_therefore_documents_for_processing(config_path=DEFAULT_CONFIG_PATH, tena
 
         # Fetch categories for tenant
         try:
-            category_list = therefore_functions.get_all_categories(
-                tenant_config['BaseUrl'],
-                tenant_config['Tenant'],
-                auth_token
-            )
+            category_list = get_categories(tenant_config, auth_token)
         except Exception as e:
             logging.error(f"Failed to get categories for tenant '{tenant_name_conf}': {e}")
             continue
@@ -72,16 +117,12 @@ def get_therefore_documents_for_processing(config_path=DEFAULT_CONFIG_PATH, tena
         # Prepare tenant DB
         os.makedirs(db_dir, exist_ok=True)
         db_path = os.path.join(db_dir, f"{tenant_name_conf}.db")
-        conn = sqlite3.connect(db_path)
+        # Autocommit mode: the module issues no implicit BEGINs, each block of
+        # rows is written in one explicit transaction
+        conn = sqlite3.connect(db_path, isolation_level=None)
+        utils.tune_sqlite(conn)
         cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS documents (
-                DocNo INTEGER PRIMARY KEY,
-                Version INTEGER,
-                Data TEXT
-            )
-        ''')
-        conn.commit()
+        cursor.execute(CREATE_DOCUMENTS_TABLE_SQL)
 
         # Process each category
         for category in category_list:
@@ -92,37 +133,22 @@ def get_therefore_documents_for_processing(config_path=DEFAULT_CONFIG_PATH, tena
 
             logging.info(f"Category No: {category['ItemNo']}, Name: {category['Name']}")
 
+            # Upsert each block of rows as it arrives so only one block is held in memory
+            processed = fetched = 0
             try:
-                rows = therefore_functions.query_all_category_documents(
+                for rows in therefore_functions.iter_all_category_documents(
                     tenant_config['BaseUrl'],
                     tenant_config['Tenant'],
                     auth_token,
                     category_no=category['ItemNo']
-                )
+                ):
+                    processed += upsert_documents(cursor, rows)
+                    fetched += len(rows)
             except Exception as e:
                 logging.error(f"Failed to fetch documents for category {category['Name']}: {e}")
-                continue
-
-            logging.info(f"Total rows fetched for category {category['Name']}: {len(rows)}")
-
-            for row in rows:
-                doc_no = row.get('DocNo')
-                version = row.get('VersionNo')
-
-                cursor.execute('SELECT Version FROM documents WHERE DocNo=?', (doc_no,))
-                result = cursor.fetchone()
-
-                if result is None or result[0] != version:
-                    cursor.execute(
-                        'REPLACE INTO documents (DocNo, Version, Data) VALUES (?, ?, ?)',
-                        (doc_no, version, json.dumps(row))
-                    )
-                    logging.info(f"Processed DocNo: {doc_no}, Version: {version}")
-                    doc_count += 1
-                else:
-                    logging.debug(f"Skipped DocNo: {doc_no}, Version: {version} (already up to date)")
 
-            conn.commit()
+            doc_count += processed
+            logging.info(f"Category {category['Name']}: processed={processed}, skipped={fetched - processed}")
 
         conn.close()
 
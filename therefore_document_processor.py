@@ -1,11 +1,16 @@
 import argparse
-import json
+import collections
+import concurrent.futures
+import hashlib
+import itertools
 import logging
 import os
+import queue
 import sqlite3
+import threading
 import time
 import datetime
-from typing import List
+from typing import Dict, List, Tuple
 
 import numpy as np
 import chromadb
@@ -22,6 +27,32 @@ DEFAULT_CONFIG_PATH = 'config/config.json'
 DEFAULT_DB_DIR = 'db/docs'
 DEFAULT_VECTORDB_DIR = 'db/vectordb'
 DEFAULT_TENANT_NAME = 'defaulttenant'
+# Fetching is network-bound, so oversubscribe the cores
+DEFAULT_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# The local embedder otherwise runs on at most 4 threads; embedding is CPU-bound
+EMBED_THREADS = os.cpu_count() or 1
+EMBED_BATCH_SIZE = 256  # chunks per embedding batch and Chroma write, gathered across documents
+FULL_EMBEDDING_DIMENSIONALITY = 768  # nomic-embed-text-v1.5 without Matryoshka truncation
+EMBED_MINI_BATCH_SIZE = 64  # texts per embed.text call, the batch size nomic uses internally
+CHROMA_WRITE_BATCH_SIZE = 1000  # caps a single add for very large documents, below Chroma's max batch size
+EMBEDDING_CACHE_SIZE = 20000  # chunk embeddings kept in memory, about 60 MB at 768 dimensions
+
+CHROMA_SETTINGS = Settings(anonymized_telemetry=False)
+# Applied when a collection is first created; larger batch and sync sizes mean
+# fewer HNSW index updates and flushes to disk while ingesting
+COLLECTION_METADATA = {
+    "hnsw:construction_ef": 100,
+    "hnsw:M": 16,
+    "hnsw:batch_size": 10000,
+    "hnsw:sync_threshold": 100000,
+}
+
+# (vectordb dir, tenant) -> (client, collection), reused across scheduled runs
+_collection_cache = {}
+
+# (model, dimensionality, chunk digest) -> embedding, least recently used first.
+# Only touched from the thread that embeds, so it needs no lock.
+_embedding_cache = collections.OrderedDict()
 
 logging.basicConfig(
     level=logging.INFO,
@@ -31,23 +62,61 @@ logging.basicConfig(
 # ----------------------------
 # Embedding & Chunking
 # ----------------------------
-def _create_embeddings_batch(texts: List[str], embedding_model="nomic-embed-text-v1.5"):
-    """Batch create embeddings for a list of text chunks."""
-    output = embed.text(
-        texts=texts,
-        model=embedding_model,
-        inference_mode="local",
-        device="cpu",
-        task_type="search_document"
-    )
-    return output["embeddings"]
+def _create_embeddings_batch(texts: List[str], embedding_model="nomic-embed-text-v1.5", dimensionality=None):
+    """Batch create a float32 embedding matrix for a list of text chunks, optionally truncated to `dimensionality`."""
+    # Boilerplate such as headers and footers repeats across documents, so
+    # only chunks not embedded recently are sent to the model
+    keys = [
+        (embedding_model, dimensionality, hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest())
+        for text in texts
+    ]
+    missing = {key: text for key, text in zip(keys, texts) if key not in _embedding_cache}
+    missing_keys, missing_texts = list(missing), list(missing.values())
+    # nomic returns Python lists of floats; embedding in mini-batches and
+    # converting each to float32 right away keeps those lists small
+    for start in range(0, len(missing_texts), EMBED_MINI_BATCH_SIZE):
+        end = start + EMBED_MINI_BATCH_SIZE
+        output = embed.text(
+            texts=missing_texts[start:end],
+            model=embedding_model,
+            inference_mode="local",
+            device="cpu",
+            task_type="search_document",
+            dimensionality=dimensionality,
+            n_threads=EMBED_THREADS  # passed through to the Embed4All constructor
+        )
+        for key, embedding in zip(missing_keys[start:end], output["embeddings"]):
+            _embedding_cache[key] = np.asarray(embedding, dtype=np.float32)
+
+    for key in keys:
+        _embedding_cache.move_to_end(key)
+    # One contiguous (len(texts), dimensions) float32 matrix, as Chroma stores it
+    embeddings = np.stack([_embedding_cache[key] for key in keys]) if keys else np.empty((0, 0), dtype=np.float32)
+    while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+        _embedding_cache.popitem(last=False)
+    return embeddings
 
 def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
-    """Split text into overlapping chunks."""
+    """Split text into overlapping chunks. Requires 0 <= overlap < chunk_size."""
+    if not 0 <= overlap < chunk_size:
+        raise ValueError(f"overlap ({overlap}) must be at least 0 and less than chunk_size ({chunk_size})")
+    stride = chunk_size - overlap
+
     words = text.split()
+    if len(words) <= chunk_size:
+        return [" ".join(words)] if words else []
+
+    # Join once and cut every chunk out as a single slice; starts[i] is the
+    # offset of word i, so words[a:b] is normalized[starts[a]:starts[b] - 1]
+    normalized = " ".join(words)
+    starts = list(itertools.accumulate((len(word) + 1 for word in words), initial=0))
+
+    # Stop once a chunk reaches the last word; later starts would only
+    # repeat the tail of the previous chunk
+    chunk_count = 1 + max(0, -(-(len(words) - chunk_size) // stride))
     return [
-        " ".join(words[i:i + chunk_size])
-        for i in range(0, len(words), chunk_size - overlap)
+        normalized[starts[start]:starts[min(start + chunk_size, len(words))] - 1]
+        for start in range(0, chunk_count * stride, stride)
     ]
 
 # ----------------------------
@@ -56,8 +125,7 @@ def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]
 def load_config(config_path=DEFAULT_CONFIG_PATH):
     if not os.path.exists(config_path):
         raise FileNotFoundError(f"Configuration file not found: {config_path}")
-    with open(config_path, 'r') as config_file:
-        return json.load(config_file)
+    return utils.load_config(config_path)
 
 def get_tenant_configs(config: dict, tenant_name: str = None) -> List[dict]:
     if tenant_name:
@@ -70,71 +138,152 @@ def get_tenant_configs(config: dict, tenant_name: str = None) -> List[dict]:
 # ----------------------------
 # Document Processing
 # ----------------------------
-def process_document(collection, tenant_config, auth_token, doc_no, version):
-    """Convert, extract text, create chunk embeddings, and store/update in Chroma."""
-    doc_id = str(doc_no)
-
-    # Version check
-    existing_chunks = collection.get(where={"parent_doc": doc_id})
-    if existing_chunks["ids"]:
-        stored_version = existing_chunks["metadatas"][0].get("version", 0)
-        if stored_version == version:
-            logging.info(f"DocNo {doc_no} already stored at version {version}. Skipping.")
-            return
-        else:
-            collection.delete(ids=existing_chunks["ids"])
-            logging.info(f"Deleted {len(existing_chunks['ids'])} old chunks for DocNo {doc_no} (old version {stored_version})")
-
-    try:
-        saved_files = therefore_functions.convert_and_save_document(
-            tenant_config['BaseUrl'],
-            tenant_config['Tenant'],
-            auth_token,
-            doc_no,
-            output_dir="output",
-            version=version
+def get_collection(vectordb_dir, tenant_name):
+    """Return the tenant's Chroma collection, opening the persistent client only once per process."""
+    key = (vectordb_dir, tenant_name)
+    if key not in _collection_cache:
+        os.makedirs(vectordb_dir, exist_ok=True)
+        client = chromadb.PersistentClient(
+            path=os.path.join(vectordb_dir, f"{tenant_name}_chroma.db"),
+            settings=CHROMA_SETTINGS
         )
+        _collection_cache[key] = (client, client.get_or_create_collection(name="documents", metadata=COLLECTION_METADATA))
+    return _collection_cache[key][1]
+
+def stored_embedding_size(collection):
+    """Return the size of the vectors stored in the collection, or None if it is empty."""
+    embeddings = collection.get(limit=1, include=["embeddings"])["embeddings"]
+    if embeddings is None or len(embeddings) == 0:
+        return None
+    return len(embeddings[0])
+
+def build_version_index(collection) -> Dict[str, Tuple[int, List[str]]]:
+    """Map each stored parent_doc to its version and chunk ids with a single collection read."""
+    stored = collection.get(include=["metadatas"])
+    version_index = {}
+    for chunk_id, metadata in zip(stored["ids"], stored["metadatas"]):
+        entry = version_index.setdefault(metadata["parent_doc"], (metadata.get("version", 0), []))
+        entry[1].append(chunk_id)
+    return version_index
+
+def fetch_document_chunks(tenant_config, auth_token, doc_no, version) -> List[str]:
+    """Convert a document and return the text chunks of all its PDFs."""
+    streams = therefore_functions.convert_document_to_bytes(
+        tenant_config['BaseUrl'],
+        tenant_config['Tenant'],
+        auth_token,
+        doc_no,
+        version=version
+    )
 
-        logging.info(f"Saved files for DocNo {doc_no}: {saved_files}")
+    logging.info(f"Converted streams for DocNo {doc_no}: {[file_name for file_name, _ in streams]}")
 
-        if not isinstance(saved_files, list) or not saved_files:
-            logging.warning(f"No valid files for DocNo {doc_no}. Skipping.")
-            return
+    if not streams:
+        logging.warning(f"No valid files for DocNo {doc_no}.")
+        return []
 
-        for file_path in saved_files:
-            if not file_path.lower().endswith('.pdf'):
-                logging.debug(f"Skipping non-PDF file: {file_path}")
-                continue
+    pdf_streams = [(file_name, file_bytes) for file_name, file_bytes in streams if file_name[-4:].lower() == '.pdf']
+    if len(pdf_streams) < len(streams):
+        logging.debug(f"Skipping {len(streams) - len(pdf_streams)} non-PDF file(s) for DocNo {doc_no}")
 
-            text = utils.extract_text_from_pdf(file_path)
-            text_chunks = chunk_text(text)
+    text_chunks = []
+    for file_name, file_bytes in pdf_streams:
+        text = utils.extract_text_from_bytes(file_bytes)
+        file_chunks = chunk_text(text)
 
-            if not text_chunks:
-                logging.warning(f"No text extracted from {file_path}. Skipping.")
-                continue
+        if not file_chunks:
+            logging.warning(f"No text extracted from {file_name}. Skipping.")
+            continue
 
-            chunk_embeddings = _create_embeddings_batch(text_chunks)
+        text_chunks.extend(file_chunks)
 
-            for idx, (chunk, emb) in enumerate(zip(text_chunks, chunk_embeddings)):
-                chunk_vector = np.array(emb)
-                collection.add(
-                    ids=[f"{doc_id}_chunk{idx}"],
-                    documents=[chunk],
-                    embeddings=[chunk_vector],
-                    metadatas=[{"version": version, "parent_doc": doc_id}]
-                )
+    return text_chunks
 
-            logging.info(f"Stored {len(text_chunks)} chunks for DocNo {doc_no}, version {version}")
+def _load_stored_embeddings(collection, version_index, pending):
+    """Map chunk text to its stored embedding for the previous versions of the pending documents."""
+    stored_ids = [chunk_id for doc_no, _, _ in pending for chunk_id in version_index.get(str(doc_no), (None, []))[1]]
+    if not stored_ids:
+        return {}
+    stored = collection.get(ids=stored_ids, include=["documents", "embeddings"])
+    return dict(zip(stored["documents"], stored["embeddings"]))
 
-            os.remove(file_path)
+def embed_document_chunks(collection, version_index, pending, dimensionality=None):
+    """Embed the chunks of several documents in one call; returns their embedding matrix, or None on failure."""
+    flat_chunks = [chunk for _, _, text_chunks in pending for chunk in text_chunks]
+    try:
+        # A new document version usually repeats most of the old text, so only
+        # chunks that are not already stored (and each distinct one once) are embedded
+        chunk_embeddings = _load_stored_embeddings(collection, version_index, pending)
+        new_chunks = list(dict.fromkeys(chunk for chunk in flat_chunks if chunk not in chunk_embeddings))
+        if new_chunks:
+            chunk_embeddings.update(zip(new_chunks, _create_embeddings_batch(new_chunks, dimensionality=dimensionality)))
+        if len(new_chunks) < len(flat_chunks):
+            logging.info(f"Reused embeddings for {len(flat_chunks) - len(new_chunks)} of {len(flat_chunks)} chunk(s)")
+        if not flat_chunks:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.asarray([chunk_embeddings[chunk] for chunk in flat_chunks], dtype=np.float32)
+    except Exception as e:
+        doc_nos = [doc_no for doc_no, _, _ in pending]
+        logging.error(f"Failed embedding chunks for DocNo(s) {doc_nos}: {e}", exc_info=True)
+        return None
+
+def write_document_chunks(collection, version_index, pending, embeddings):
+    """Replace the stored chunks of several documents with their new chunks and embeddings."""
+    # One delete and as few adds as possible for the whole batch of documents
+    stale_ids = []
+    ids, documents, metadatas = [], [], []
+    for doc_no, version, text_chunks in pending:
+        doc_id = str(doc_no)
+        stale_ids.extend(version_index.get(doc_id, (None, []))[1])
+        ids.extend(f"{doc_id}_chunk{idx}" for idx in range(len(text_chunks)))
+        documents.extend(text_chunks)
+        metadatas.extend([{"version": version, "parent_doc": doc_id}] * len(text_chunks))
 
+    try:
+        if stale_ids:
+            collection.delete(ids=stale_ids)
+        for start in range(0, len(ids), CHROMA_WRITE_BATCH_SIZE):
+            end = start + CHROMA_WRITE_BATCH_SIZE
+            collection.add(
+                ids=ids[start:end],
+                documents=documents[start:end],
+                embeddings=embeddings[start:end],
+                metadatas=metadatas[start:end]
+            )
     except Exception as e:
-        logging.error(f"Failed processing DocNo {doc_no}: {e}", exc_info=True)
+        doc_nos = [doc_no for doc_no, _, _ in pending]
+        logging.error(f"Failed storing chunks for DocNo(s) {doc_nos}: {e}", exc_info=True)
+        # Drop the index entries so these documents are redone on the next run
+        for doc_no in doc_nos:
+            version_index.pop(str(doc_no), None)
+        return
+
+    offset = 0
+    for doc_no, version, text_chunks in pending:
+        doc_id = str(doc_no)
+        if text_chunks:
+            version_index[doc_id] = (version, ids[offset:offset + len(text_chunks)])
+        else:
+            version_index.pop(doc_id, None)
+        offset += len(text_chunks)
+
+    logging.info(
+        f"Stored {len(ids)} chunks for {len(pending)} document(s), "
+        f"replacing {len(stale_ids)} old chunks"
+    )
+
+def _chroma_writer(collection, version_index, write_queue):
+    """Write embedded batches from `write_queue` to Chroma until a None sentinel arrives."""
+    while True:
+        batch = write_queue.get()
+        if batch is None:
+            return
+        write_document_chunks(collection, version_index, *batch)
 
 # ----------------------------
 # Tenant Processing with summary
 # ----------------------------
-def process_tenant(tenant_config, db_dir, vectordb_dir):
+def process_tenant(tenant_config, db_dir, vectordb_dir, max_workers=DEFAULT_MAX_WORKERS):
     tenant_name = tenant_config.get('Tenant', DEFAULT_TENANT_NAME)
     logging.info(f"Processing tenant: {tenant_name}")
 
@@ -146,12 +295,27 @@ def process_tenant(tenant_config, db_dir, vectordb_dir):
         tenant_config['Password']
     )
 
+    # nomic-embed-text-v1.5 is a Matryoshka model, so e.g. 384 instead of the full 768
+    # dimensions halves every stored vector. A collection must keep one size throughout.
+    dimensionality = tenant_config.get('EmbeddingDimensionality')
+    if dimensionality is not None and (
+        isinstance(dimensionality, bool)
+        or not isinstance(dimensionality, int)
+        or not 0 < dimensionality <= FULL_EMBEDDING_DIMENSIONALITY
+    ):
+        logging.error(
+            f"Invalid EmbeddingDimensionality for tenant '{tenant_name}': {dimensionality!r} "
+            f"(expected an integer from 1 to {FULL_EMBEDDING_DIMENSIONALITY})"
+        )
+        return doc_count, 0
+
     db_path = os.path.join(db_dir, f"{tenant_name}.db")
     if not os.path.exists(db_path):
         logging.warning(f"Database not found for tenant '{tenant_name}': {db_path}")
         return doc_count, 0  # return summary data
 
     conn = sqlite3.connect(db_path)
+    utils.tune_sqlite(conn)
     cursor = conn.cursor()
     cursor.execute("SELECT DocNo, Version FROM documents")
     docs_to_process = cursor.fetchall()
@@ -160,22 +324,76 @@ def process_tenant(tenant_config, db_dir, vectordb_dir):
     total_docs = len(docs_to_process)
     logging.info(f"Found {total_docs} documents to process.")
 
-    os.makedirs(vectordb_dir, exist_ok=True)
-    client = chromadb.PersistentClient(
-        path=os.path.join(vectordb_dir, f"{tenant_name}_chroma.db"),
-        settings=Settings(anonymized_telemetry=False)
-    )
-    collection = client.get_or_create_collection(name="documents")
-
-    for idx, (doc_no, version) in enumerate(docs_to_process, 1):
-        doc_start = time.time()
-        logging.info(f"Processing document {idx}/{total_docs} (DocNo: {doc_no}, Version: {version})")
-
-        process_document(collection, tenant_config, auth_token, doc_no, version)
-        doc_elapsed = time.time() - doc_start
-
-        doc_count += 1
-        logging.info(f"Finished DocNo {doc_no} in {doc_elapsed:.2f} seconds ({doc_elapsed/60:.2f} minutes)")
+    collection = get_collection(vectordb_dir, tenant_name)
+    # Chroma rejects vectors of another size only at add time, after the old
+    # chunks are deleted, so a changed setting would drop documents from the index
+    stored_size = stored_embedding_size(collection)
+    expected_size = dimensionality or FULL_EMBEDDING_DIMENSIONALITY
+    if stored_size is not None and stored_size != expected_size:
+        logging.error(
+            f"EmbeddingDimensionality {expected_size} for tenant '{tenant_name}' does not match "
+            f"the {stored_size}-dimensional vectors already stored; skipping tenant."
+        )
+        return doc_count, 0
+    version_index = build_version_index(collection)
+
+    # Only documents whose current version is not stored yet are downloaded
+    stored = {(parent_doc, entry[0]) for parent_doc, entry in version_index.items()}
+    docs_to_fetch = [(doc_no, version) for doc_no, version in docs_to_process if (str(doc_no), version) not in stored]
+    doc_count += total_docs - len(docs_to_fetch)
+    if doc_count:
+        logging.info(f"Skipping {doc_count} document(s) already stored at their current version.")
+
+    # Three stages run side by side: worker threads fetch and extract several
+    # documents at once, this thread embeds their chunks in batches of
+    # EMBED_BATCH_SIZE across documents, and a writer thread stores each
+    # embedded batch in Chroma. At most 2 * max_workers fetches and 2 embedded
+    # batches are queued, so memory stays bounded when one stage runs ahead.
+    write_queue = queue.Queue(maxsize=2)
+    writer = threading.Thread(target=_chroma_writer, args=(collection, version_index, write_queue), daemon=True)
+    writer.start()
+
+    def flush(pending):
+        embeddings = embed_document_chunks(collection, version_index, pending, dimensionality)
+        if embeddings is not None:
+            write_queue.put((pending, embeddings))
+
+    pending = []
+    pending_chunks = 0
+    docs_iter = iter(docs_to_fetch)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            while True:
+                for doc_no, version in itertools.islice(docs_iter, 2 * max_workers - len(futures)):
+                    future = executor.submit(fetch_document_chunks, tenant_config, auth_token, doc_no, version)
+                    futures[future] = (doc_no, version)
+                if not futures:
+                    break
+
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    doc_no, version = futures.pop(future)
+                    doc_count += 1
+                    try:
+                        text_chunks = future.result()
+                    except Exception as e:
+                        logging.error(f"Failed processing DocNo {doc_no}: {e}", exc_info=True)
+                        continue
+
+                    logging.info(f"Fetched DocNo {doc_no} ({doc_count}/{total_docs})")
+                    pending.append((doc_no, version, text_chunks))
+                    pending_chunks += len(text_chunks)
+                    if pending_chunks >= EMBED_BATCH_SIZE:
+                        flush(pending)
+                        pending, pending_chunks = [], 0
+
+        if pending:
+            flush(pending)
+    finally:
+        # Let the writer finish the queued batches before the tenant is done
+        write_queue.put(None)
+        writer.join()
 
     tenant_elapsed = time.time() - tenant_start
     avg_time = tenant_elapsed / doc_count if doc_count > 0 else 0
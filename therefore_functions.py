@@ -1,11 +1,51 @@
-import json
+import base64
+import concurrent.futures
 import http.client
-import os
-import uuid
+import threading
+
+import utils
+
+REQUEST_TIMEOUT = 300  # seconds; large conversions can take minutes
+
+# Keep-alive connections per thread and base URL; http.client connections
+# must not be shared between threads
+_thread_local = threading.local()
+
+def _connect(base_url):
+    # A single connection can be reused for many requests (HTTP keep-alive),
+    # saving a TCP + TLS handshake per call
+    return http.client.HTTPSConnection(base_url.replace('https://', ''), timeout=REQUEST_TIMEOUT)
+
+def _get_connection(base_url):
+    connections = getattr(_thread_local, "connections", None)
+    if connections is None:
+        connections = _thread_local.connections = {}
+    if base_url not in connections:
+        connections[base_url] = _connect(base_url)
+    return connections[base_url]
+
+def _send(conn, path, payload, headers):
+    try:
+        conn.request("POST", path, payload, headers)
+        res = conn.getresponse()
+        # Always drain the body so the connection is ready for the next request
+        return res, res.read()
+    except (OSError, http.client.HTTPException):
+        # Don't leave a half-read response on the cached connection; the next
+        # request on it reconnects
+        conn.close()
+        raise
+
+def _post(conn, path, payload, headers):
+    try:
+        return _send(conn, path, payload, headers)
+    except (http.client.RemoteDisconnected, http.client.ImproperConnectionState, ConnectionError):
+        # The server closed an idle keep-alive connection; reconnect once
+        return _send(conn, path, payload, headers)
 
 def _get_therefore_converted_document(base_url, tenant, auth_token, doc_no, version=0):
-    conn = http.client.HTTPSConnection(base_url.replace('https://', ''))
-    payload = json.dumps({
+    conn = _get_connection(base_url)
+    payload = utils.dumps_json_bytes({
     "ConversionOptions": {
         "AnnotationMode": 0,
         "ConvertTo": 5,
@@ -20,43 +60,33 @@ def _get_therefore_converted_document(base_url, tenant, auth_token, doc_no, vers
         'Content-Type': 'application/json',
         'Authorization': auth_token
     }
-    conn.request("POST", "/theservice/v0001/restun/GetConvertedDocStreams", payload, headers)
-    res = conn.getresponse()
+    res, data = _post(conn, "/theservice/v0001/restun/GetConvertedDocStreams", payload, headers)
     if res.status != 200:
         raise Exception(f"Failed to fetch converted document: {res.status} {res.reason}")
-    data = res.read()
-    response_json = json.loads(data.decode("utf-8"))
-    return  response_json
-
-def _save_therefore_converted_document(converted_document, output_dir):
-    saved_files = []
-    streams = converted_document.get("Streams", [])
-    for stream in streams:
+    return utils.loads_json(data)
+
+def _decode_file_data(file_data):
+    # FileData may arrive as base64 text or as a JSON list of byte values
+    if isinstance(file_data, str):
+        return base64.b64decode(file_data)
+    return bytes(file_data)
+
+def _get_converted_streams(converted_document):
+    streams = []
+    for stream in converted_document.get("Streams", []):
         file_data = stream.get("FileData")
-        file_name = stream.get("FileName", "output.pdf")
-        file_path = os.path.join(output_dir, file_name)
-        if os.path.exists(file_path):
-            unique_id = uuid.uuid4().hex[:8]  # Generate a unique ID
-            file_name = f"{os.path.splitext(file_name)[0]}_{unique_id}{os.path.splitext(file_name)[1]}"
         if file_data:
-            file_bytes = bytes(file_data)
-            file_path = os.path.join(output_dir, file_name)
-            with open(file_path, "wb") as f:
-                f.write(file_bytes)
-            print(f"Saved: {file_path}")
-            saved_files.append(file_path)
-    return saved_files
-
-def convert_and_save_document(base_url, tenant, auth_token, doc_no, output_dir, version=0):
-    try:
-        converted_document = _get_therefore_converted_document(base_url, tenant, auth_token, doc_no, version)
-        return _save_therefore_converted_document(converted_document, output_dir)
-    except Exception as e:
-        print(f"Failed to convert and save document {doc_no}: {e}")
-
-def query_all_category_documents(base_url, tenant, auth_token, category_no, max_rows=5000000, row_block_size=500):
-    conn = http.client.HTTPSConnection(base_url.replace('https://', ''))
-    payload = json.dumps({
+            streams.append((stream.get("FileName", "output.pdf"), _decode_file_data(file_data)))
+    return streams
+
+def convert_document_to_bytes(base_url, tenant, auth_token, doc_no, version=0):
+    converted_document = _get_therefore_converted_document(base_url, tenant, auth_token, doc_no, version)
+    return _get_converted_streams(converted_document)
+
+def iter_all_category_documents(base_url, tenant, auth_token, category_no, max_rows=5000000, row_block_size=500):
+    # Yields one block of at most row_block_size rows at a time. The next
+    # block is requested while the caller works on the current one.
+    payload = utils.dumps_json_bytes({
         "Query": {
             "CategoryNo": category_no,
             "MaxRows": max_rows,
@@ -69,60 +99,64 @@ def query_all_category_documents(base_url, tenant, auth_token, category_no, max_
         'Content-Type': 'application/json',
         'Authorization': auth_token
     }
-    # Initial query
-    conn.request("POST", "/theservice/v0001/restun/ExecuteAsyncSingleQuery", payload, headers)
-    res = conn.getresponse()
-    data = res.read()
-    response = json.loads(data.decode("utf-8"))
-
-    query_id = response["QueryId"]
-    all_rows = response["QueryResult"]["ResultRows"]
-    has_remaining = response.get("HasRemainingRows", False)
-
-    # Fetch additional rows if needed
-    while has_remaining:
-        next_payload = json.dumps({"QueryID": query_id, "RowBlockSize": row_block_size})
-        conn.request("POST", "/theservice/v0001/restun/GetNextSingleQueryRows", next_payload, headers)
-        res = conn.getresponse()
-        data = res.read()
-        next_response = json.loads(data.decode("utf-8"))
-        all_rows.extend(next_response["QueryResult"]["ResultRows"])
-        has_remaining = next_response.get("HasRemainingRows", False)
 
-    # Release the query
-    release_payload = json.dumps({"QueryID": query_id})
-    conn.request("POST", "/theservice/v0001/restun/ReleaseSingleQuery", release_payload, headers)
-    conn.getresponse().read()  # Consume response
+    # Resolved on the caller's thread, so the paging reuses its keep-alive
+    # connection instead of opening one per query
+    conn = _get_connection(base_url)
+
+    def query(path, body):
+        # Always runs on the executor's one thread, so requests on the
+        # connection never overlap
+        res, data = _post(conn, path, body, headers)
+        return utils.loads_json(data)
 
-    return all_rows
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        # Initial query
+        response = executor.submit(query, "/theservice/v0001/restun/ExecuteAsyncSingleQuery", payload).result()
 
+        query_id = response["QueryId"]
+        next_payload = utils.dumps_json_bytes({"QueryID": query_id, "RowBlockSize": row_block_size})
+        try:
+            while True:
+                next_future = None
+                if response.get("HasRemainingRows", False):
+                    next_future = executor.submit(query, "/theservice/v0001/restun/GetNextSingleQueryRows", next_payload)
+                yield response["QueryResult"]["ResultRows"]
+                if next_future is None:
+                    break
+                response = next_future.result()
+        finally:
+            # Release the query, also when the caller stops early; this queues
+            # behind a prefetch that is still running
+            release_payload = utils.dumps_json_bytes({"QueryID": query_id})
+            executor.submit(query, "/theservice/v0001/restun/ReleaseSingleQuery", release_payload).result()
 
 def _get_items_of_type(node, results, type = 2):
-    if isinstance(node, dict):
-        if node.get('ItemType') == type:
-            results.append({'ItemNo': node.get('ItemNo'), 'Name': node.get('Name')})
-        # Recursively check for child items
-        for key in node:
-            if isinstance(node[key], list):
-                for item in node[key]:
-                    _get_items_of_type(item, results, type)
-    elif isinstance(node, list):
-        for item in node:
-            _get_items_of_type(item, results, type)
+    # Depth-first walk with an explicit stack; children are pushed in reverse
+    # so items come out in the same order as a recursive walk
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if node.get('ItemType') == type:
+                results.append({'ItemNo': node.get('ItemNo'), 'Name': node.get('Name')})
+            # Child items can sit under any list-valued key
+            children = [value for value in node.values() if isinstance(value, list)]
+            for value in reversed(children):
+                stack.extend(reversed(value))
+        elif isinstance(node, list):
+            stack.extend(reversed(node))
 
 def get_all_categories(base_url, tenant, auth_token):
-    # Create connection and request
-    conn = http.client.HTTPSConnection(base_url.replace('https://', ''))
-    payload = json.dumps({})
+    conn = _get_connection(base_url)
+    payload = utils.dumps_json_bytes({})
     headers = {
         'TenantName': tenant,
         'Content-Type': 'application/json',
         'Authorization': auth_token
     }
-    conn.request("POST", "/theservice/v0001/restun/GetCategoriesTree", payload, headers)
-    res = conn.getresponse()
-    data = res.read()
-    response_json = json.loads(data.decode("utf-8"))
+    res, data = _post(conn, "/theservice/v0001/restun/GetCategoriesTree", payload, headers)
+    response_json = utils.loads_json(data)
     category_list = []
     _get_items_of_type(response_json.get('TreeItems', []), category_list, type=2)
     return category_list
\ No newline at end of file